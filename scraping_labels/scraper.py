@@ -1,19 +1,69 @@
-import xml.etree.ElementTree as ET
+import os
+import sys
+import xml.sax
 import requests
 # import gzip
 from collections import defaultdict
-import json
+from functools import cached_property
+from itertools import combinations
+import orjson
+
+# Element -> (depth, field) for the text we keep. The MeSH descriptor schema is fixed, so the
+# depth alone tells DescriptorRecord/DescriptorName/String apart from other nested Strings
+CAPTURED_FIELDS = {
+    'TreeNumber': (3, 'tree'),  # DescriptorRecord/TreeNumberList/TreeNumber
+    'String': (3, 'name'),  # DescriptorRecord/DescriptorName/String
+}
+
+class MeSHDescriptorHandler(xml.sax.ContentHandler):
+    """
+    SAX handler that pulls the descriptor name and tree numbers out of each
+    DescriptorRecord and hands them to the extractor
+    """
+    def __init__(self, extractor):
+        super().__init__()
+        # Bound once here, the callback runs for every tree number
+        self.record_tree = extractor._record_tree
+        self.depth = 0
+        self.field = None
+        self.chars = []
+        self.cur_name = None
+    
+    def startElement(self, name, attrs):
+        # Most elements are not captured, a single lookup rules them out
+        capture = CAPTURED_FIELDS.get(name)
+        if capture is not None and capture[0] == self.depth:
+            self.field = capture[1]
+            self.chars = []
+        self.depth += 1
+    
+    def characters(self, content):
+        if self.field is not None:
+            self.chars.append(content)
+    
+    def endElement(self, name):
+        self.depth -= 1
+        
+        if self.field == 'tree':
+            self.record_tree(self.cur_name, sys.intern(''.join(self.chars)))
+        elif self.field == 'name':
+            self.cur_name = sys.intern(''.join(self.chars))
+        elif name == 'DescriptorRecord':
+            self.cur_name = None
+        self.field = None
 
 class MeSHHierarchyExtractor:
     def __init__(self):
         self.mesh_hierarchy = defaultdict(list)
         self.descriptor_to_tree = defaultdict(list)
         self.tree_to_descriptor = {}
-        self.parent_child_relations = defaultdict(set)
+        self.parent_child_relations = defaultdict(list)
         
     def download_mesh_xml(self, year=2020):
         """
         Download MeSH XML files for the specified year
+        Returns the streaming Response, use it in a with block and pass response.raw to parse_mesh_xml
+        so the connection is released once parsing finishes
         """
         base_url = f"https://nlmpubs.nlm.nih.gov/projects/mesh/MESH_FILES/xmlmesh/"
         
@@ -22,94 +72,128 @@ class MeSHHierarchyExtractor:
         
         print(f"Downloading MeSH descriptors for {year}...")
         try:
-            response = requests.get(descriptor_url)
+            response = requests.get(descriptor_url, stream=True, headers={'Accept-Encoding': 'gzip, deflate'})
             response.raise_for_status()
-            return response.content
         except requests.exceptions.RequestException as e:
+            if e.response is not None:
+                e.response.close()
             print(f"Error downloading: {e}")
             print("Try downloading manually from: https://nlmpubs.nlm.nih.gov/projects/mesh/")
             return None
+        
+        # Let urllib3 undo the transfer compression as the parser reads from the stream
+        response.raw.decode_content = True
+        return response
     
-    def parse_mesh_xml(self, xml_content):
+    def parse_mesh_xml(self, xml_source):
         """
         Parse MeSH XML and extract hierarchical relationships
+        xml_source can be a file path or a binary file-like object (e.g. a download stream)
         """
-        if isinstance(xml_content, bytes):
-            xml_content = xml_content.decode('utf-8')
-            
-        root = ET.fromstring(xml_content)
+        # Drop any similar pairs enumerated from previously parsed data
+        self.__dict__.pop('similar_pairs', None)
         
-        for descriptor_record in root.findall('.//DescriptorRecord'):
-            # Get descriptor UI and name
-            descriptor_ui = descriptor_record.find('DescriptorUI').text
-            descriptor_name = descriptor_record.find('DescriptorName/String').text
-            
-            # Get tree numbers (hierarchy positions)
-            tree_number_list = descriptor_record.find('TreeNumberList')
-            if tree_number_list is not None:
-                for tree_number_elem in tree_number_list.findall('TreeNumber'):
-                    tree_number = tree_number_elem.text
-                    
-                    # Store mappings
-                    self.descriptor_to_tree[descriptor_name].append(tree_number)
-                    self.tree_to_descriptor[tree_number] = descriptor_name
-                    
-                    # Extract parent-child relationships
-                    self._extract_hierarchy_relations(tree_number, descriptor_name)
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(MeSHDescriptorHandler(self))
+        
+        # Open paths ourselves, xml.sax would otherwise treat a missing file name as a URL
+        if isinstance(xml_source, (str, os.PathLike)):
+            with open(xml_source, 'rb') as f:
+                parser.parse(f)
+        else:
+            parser.parse(xml_source)
+        
+        # Extract parent-child relationships once every tree number is known
+        self._extract_hierarchy_relations()
+    
+    def _record_tree(self, descriptor_name, tree_number):
+        """
+        Store the mappings for one tree number of a descriptor
+        """
+        self.descriptor_to_tree[descriptor_name].append(tree_number)
+        self.tree_to_descriptor[tree_number] = descriptor_name
     
-    def _extract_hierarchy_relations(self, tree_number, descriptor_name):
+    def _extract_hierarchy_relations(self):
         """
         Extract parent-child relationships from tree numbers
-        Tree numbers like C01.123.456 indicate hierarchy levels
+        Tree numbers like C01.123.456 indicate hierarchy levels, the parent being C01.123
         """
-        parts = tree_number.split('.')
+        tree_to_descriptor = self.tree_to_descriptor
+        parent_child_relations = self.parent_child_relations
         
-        # Build parent tree numbers
-        for i in range(1, len(parts)):
-            parent_tree = '.'.join(parts[:i])
-            child_tree = '.'.join(parts[:i+1])
+        for tree_number, descriptor_name in tree_to_descriptor.items():
+            separator = tree_number.rfind('.')
+            if separator == -1:
+                continue
             
-            if parent_tree in self.tree_to_descriptor and child_tree in self.tree_to_descriptor:
-                parent_name = self.tree_to_descriptor[parent_tree]
-                child_name = self.tree_to_descriptor[child_tree]
-                self.parent_child_relations[parent_name].add(child_name)
+            parent_name = tree_to_descriptor.get(tree_number[:separator])
+            if parent_name is not None:
+                parent_child_relations[parent_name].append(descriptor_name)
+        
+        # A descriptor can sit under the same parent via several tree numbers, keep each child once
+        for parent_name, children in parent_child_relations.items():
+            parent_child_relations[parent_name] = list(dict.fromkeys(children))
     
     def get_label_hierarchy_for_micol(self):
         """
         Generate label-label similarity pairs for MICoL enhancement
         Returns pairs of (label1, label2) that are hierarchically related
         """
-        similar_pairs = []
-        
-        # Parent-child relationships (strong similarity)
+        return self.similar_pairs
+    
+    @cached_property
+    def similar_pairs(self):
+        """
+        All (label1, label2, relation) pairs as a list, enumerated once and reused on later calls
+        save_hierarchy_data streams the pairs instead, so saving never builds this list
+        """
+        return list(self._iter_similar_pairs())
+    
+    def _iter_similar_pairs(self):
+        """
+        Yield (label1, label2, relation) pairs one at a time so they can be streamed to disk
+        """
         for parent, children in self.parent_child_relations.items():
+            # Parent-child relationships (strong similarity)
             for child in children:
-                similar_pairs.append((parent, child, "parent_child"))
-        
-        # Sibling relationships (medium similarity)
-        for parent, children in self.parent_child_relations.items():
-            children_list = list(children)
-            for i, child1 in enumerate(children_list):
-                for child2 in children_list[i+1:]:
-                    similar_pairs.append((child1, child2, "siblings"))
-        
-        return similar_pairs
+                yield (parent, child, "parent_child")
+            
+            # Sibling relationships (medium similarity)
+            for child1, child2 in combinations(children, 2):
+                yield (child1, child2, "siblings")
     
-    def save_hierarchy_data(self, output_file="mesh_hierarchy.json"):
+    def _save_similar_pairs(self, pairs_file):
+        """
+        Write similar pairs as JSON lines, one [label1, label2, relation] row per line
+        """
+        count = 0
+        with open(pairs_file, 'wb') as f:
+            for row in self._iter_similar_pairs():
+                f.write(orjson.dumps(row))
+                f.write(b'\n')
+                count += 1
+        return count
+    
+    def save_hierarchy_data(self, output_file="mesh_hierarchy.json", pairs_file="mesh_similar_pairs.jsonl"):
         """
         Save extracted hierarchy data to JSON file
         """
         hierarchy_data = {
             "descriptor_to_tree": dict(self.descriptor_to_tree),
             "tree_to_descriptor": self.tree_to_descriptor,
-            "parent_child_relations": {k: list(v) for k, v in self.parent_child_relations.items()},
-            "similar_pairs": self.get_label_hierarchy_for_micol()
+            "parent_child_relations": dict(self.parent_child_relations)  # Children are already deduplicated lists
         }
         
-        with open(output_file, 'w') as f:
-            json.dump(hierarchy_data, f, indent=2)
+        # Similar pairs can run into the millions, so they are streamed to their own file
+        hierarchy_data["similar_pairs_file"] = pairs_file
+        hierarchy_data["similar_pairs_count"] = self._save_similar_pairs(pairs_file)
+        
+        # orjson serialises (and indents) in C, so the file stays readable at a fraction of the cost
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(hierarchy_data, option=orjson.OPT_INDENT_2))
         
         print(f"Hierarchy data saved to {output_file}")
+        print(f"Similar pairs saved to {pairs_file}")
         return hierarchy_data
 
 def main():
@@ -117,20 +201,16 @@ def main():
     extractor = MeSHHierarchyExtractor()
     
     # Option 1: Download automatically (may not work due to file sizes)
-    # xml_content = extractor.download_mesh_xml(2025)
-    # save above xml to a file
-    # if xml_content:
-    #     with open('desc2025.xml', 'wb') as f:
-    #         f.write(xml_content)
+    # response = extractor.download_mesh_xml(2025)
+    # if response:
+    #     with response:
+    #         extractor.parse_mesh_xml(response.raw)
     
     # Option 2: Load from local file (recommended)
     # Download desc2020.xml manually and load it
     try:
-        with open('desc2025.xml', 'r', encoding='utf-8') as f:
-            xml_content = f.read()
-        
         print("Parsing MeSH XML...")
-        extractor.parse_mesh_xml(xml_content)
+        extractor.parse_mesh_xml('desc2025.xml')
         
         print("Extracting hierarchy relationships...")
         hierarchy_data = extractor.save_hierarchy_data()
@@ -139,12 +219,12 @@ def main():
         print(f"\nStatistics:")
         print(f"Total descriptors: {len(extractor.tree_to_descriptor)}")
         print(f"Total parent-child relations: {sum(len(children) for children in extractor.parent_child_relations.values())}")
-        print(f"Total similar pairs for training: {len(hierarchy_data['similar_pairs'])}")
+        print(f"Total similar pairs for training: {hierarchy_data['similar_pairs_count']}")
         
         # Show example relationships
         print(f"\nExample parent-child relationships:")
         for parent, children in list(extractor.parent_child_relations.items())[:5]:
-            print(f"  {parent} -> {list(children)[:3]}...")
+            print(f"  {parent} -> {children[:3]}...")
             
     except FileNotFoundError:
         print("Please download desc2020.xml from https://nlmpubs.nlm.nih.gov/projects/mesh/")
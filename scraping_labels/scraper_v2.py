@@ -1,22 +1,117 @@
-import xml.etree.ElementTree as ET
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import xml.sax
 import requests
 import gzip
 from collections import defaultdict
-import json
+from functools import cached_property
+import orjson
+import pandas as pd
+
+# On-disk cache of parsed MeSH files, bump CACHE_VERSION whenever the parsed state changes shape
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mesh")
+# Only plain dicts/lists are cached, the pandas tables are rebuilt on load so a pandas upgrade
+# cannot leave behind pickles it is unable to read
+CACHE_VERSION = "2"
+CACHED_ATTRIBUTES = (
+    "descriptor_details", "descriptor_to_tree", "tree_to_descriptor", "ui_to_tree", "tree_to_ui"
+)
+
+# Element -> (depth, field) for the text we keep. The MeSH descriptor schema is fixed, so the
+# depth alone tells e.g. DescriptorRecord/DescriptorName/String (depth 3) apart from the
+# DescriptorName/String nested under PharmacologicalAction or SeeRelatedDescriptor
+CAPTURED_FIELDS = {
+    'TreeNumber': (3, 'tree'),  # DescriptorRecord/TreeNumberList/TreeNumber
+    'DescriptorUI': (2, 'ui'),  # MeSH Unique ID (most important - primary identifier)
+    'String': (3, 'name'),  # DescriptorRecord/DescriptorName/String
+    'Annotation': (2, 'annotation'),
+    'ScopeNote': (4, 'scope'),  # DescriptorRecord/ConceptList/Concept/ScopeNote
+}
+
+class MeSHDescriptorHandler(xml.sax.ContentHandler):
+    """
+    SAX handler that pulls only the fields we need out of each DescriptorRecord
+    and hands them to the extractor, without building any element objects
+    """
+    def __init__(self, extractor):
+        super().__init__()
+        # Bound once here, the callbacks run for every record / tree number
+        self.record_tree = extractor._record_tree
+        self.record_descriptor = extractor._record_descriptor
+        self.depth = 0
+        self.field = None
+        self.chars = []
+        self._reset_record()
+    
+    def _reset_record(self):
+        self.cur_ui = None
+        self.cur_name = None
+        self.cur_ann = None
+        self.cur_scope = None
+        self.cur_trees = []
+    
+    def startElement(self, name, attrs):
+        # Most elements are not captured, a single lookup rules them out
+        capture = CAPTURED_FIELDS.get(name)
+        if capture is not None and capture[0] == self.depth:
+            self.field = capture[1]
+            self.chars = []
+        self.depth += 1
+    
+    def characters(self, content):
+        if self.field is not None:
+            self.chars.append(content)
+    
+    def endElement(self, name):
+        self.depth -= 1
+        
+        if self.field is not None:
+            # IDs, names and tree numbers are repeated across every map, so they are interned
+            text = ''.join(self.chars)
+            field = self.field
+            self.field = None
+            
+            if field == 'tree':
+                # Skip records without an ID or name, as before
+                if self.cur_ui is not None and self.cur_name is not None:
+                    text = sys.intern(text)
+                    self.cur_trees.append(text)
+                    self.record_tree(self.cur_ui, self.cur_name, text)
+            elif field == 'ui':
+                self.cur_ui = sys.intern(text)
+            elif field == 'name':
+                self.cur_name = sys.intern(text)
+            elif field == 'annotation':
+                self.cur_ann = text
+            elif self.cur_scope is None:
+                # Alternative definition: first concept scope note
+                self.cur_scope = text
+        elif name == 'DescriptorRecord':
+            if self.cur_ui is not None and self.cur_name is not None:
+                definition = self.cur_ann or self.cur_scope or ""
+                self.record_descriptor(self.cur_ui, self.cur_name, definition, self.cur_trees)
+            self._reset_record()
 
 class MeSHHierarchyExtractor:
     def __init__(self):
         self.mesh_hierarchy = defaultdict(list)
         self.descriptor_to_tree = defaultdict(list)
         self.tree_to_descriptor = {}
-        self.parent_child_relations = defaultdict(set)
+        self.parent_child_relations = defaultdict(list)
         self.descriptor_details = {}  # Store complete MeSH information
         self.ui_to_tree = defaultdict(list)  # MeSH ID to tree numbers
         self.tree_to_ui = {}  # Tree number to MeSH ID
+        self.tree_table = None  # Columnar (name, tree, parent_tree) rows, built after parsing
+        self.hierarchy_edges = None  # (parent_name, name) edges, built after parsing
         
     def download_mesh_xml(self, year=2020):
         """
         Download MeSH XML files for the specified year
+        Returns the streaming Response, use it in a with block and pass response.raw to parse_mesh_xml
+        so the connection is released once parsing finishes
         """
         base_url = f"https://nlmpubs.nlm.nih.gov/projects/mesh/MESH_FILES/xmlmesh/"
         
@@ -25,121 +120,223 @@ class MeSHHierarchyExtractor:
         
         print(f"Downloading MeSH descriptors for {year}...")
         try:
-            response = requests.get(descriptor_url)
+            response = requests.get(descriptor_url, stream=True, headers={'Accept-Encoding': 'gzip, deflate'})
             response.raise_for_status()
-            return response.content
         except requests.exceptions.RequestException as e:
+            if e.response is not None:
+                e.response.close()
             print(f"Error downloading: {e}")
             print("Try downloading manually from: https://nlmpubs.nlm.nih.gov/projects/mesh/")
             return None
+        
+        # Let urllib3 undo the transfer compression as the parser reads from the stream
+        response.raw.decode_content = True
+        return response
     
-    def parse_mesh_xml(self, xml_content):
+    def parse_mesh_xml(self, xml_source, use_cache=True):
         """
         Parse MeSH XML and extract hierarchical relationships with key identifiers
+        xml_source can be a file path or a binary file-like object (e.g. a download stream),
+        only file paths are looked up in / written to the on-disk cache
         """
-        if isinstance(xml_content, bytes):
-            xml_content = xml_content.decode('utf-8')
-            
-        root = ET.fromstring(xml_content)
+        # Drop any search index / similar pairs built over previously parsed data
+        self.__dict__.pop('_name_lower_to_ui', None)
+        self.__dict__.pop('similar_pairs', None)
+        self.__dict__.pop('_similar_pairs_table', None)
         
-        # Store complete descriptor information
-        self.descriptor_details = {}
+        # Parsed results are cached by file content, so re-runs on the same year skip the parse
+        cache_key = None
+        if use_cache and isinstance(xml_source, (str, os.PathLike)):
+            cache_key = self._cache_key(xml_source)
+            if self._load_cache(cache_key):
+                print(f"Loaded parsed MeSH data from cache ({cache_key})")
+                self._extract_hierarchy_relations()
+                return
         
-        for descriptor_record in root.findall('.//DescriptorRecord'):
-            # Get MeSH Unique ID (most important - primary identifier)
-            descriptor_ui_elem = descriptor_record.find('DescriptorUI')
-            if descriptor_ui_elem is None:
-                continue
-            descriptor_ui = descriptor_ui_elem.text
-            
-            # Get descriptor name
-            descriptor_name_elem = descriptor_record.find('DescriptorName/String')
-            if descriptor_name_elem is None:
-                continue
-            descriptor_name = descriptor_name_elem.text
-            
-            # Get annotation/definition (scope note)
-            annotation = ""
-            annotation_elem = descriptor_record.find('Annotation')
-            if annotation_elem is not None:
-                annotation = annotation_elem.text
-            
-            # Alternative: Get concept scope note
-            if not annotation:
-                concept_elem = descriptor_record.find('.//Concept/ScopeNote')
-                if concept_elem is not None:
-                    annotation = concept_elem.text
-            
-            # Store complete descriptor details
-            self.descriptor_details[descriptor_ui] = {
-                'mesh_id': descriptor_ui,
-                'name': descriptor_name,
-                'definition': annotation or "",
-                'tree_numbers': []
-            }
-            
-            # Get tree numbers (hierarchy positions)
-            tree_number_list = descriptor_record.find('TreeNumberList')
-            if tree_number_list is not None:
-                for tree_number_elem in tree_number_list.findall('TreeNumber'):
-                    tree_number = tree_number_elem.text
-                    
-                    # Add to descriptor details
-                    self.descriptor_details[descriptor_ui]['tree_numbers'].append(tree_number)
-                    
-                    # Store mappings (keeping original functionality)
-                    self.descriptor_to_tree[descriptor_name].append(tree_number)
-                    self.tree_to_descriptor[tree_number] = descriptor_name
-                    
-                    # Store UI to tree mapping
-                    if not hasattr(self, 'ui_to_tree'):
-                        self.ui_to_tree = defaultdict(list)
-                    self.ui_to_tree[descriptor_ui].append(tree_number)
-                    
-                    # Store tree to UI mapping
-                    if not hasattr(self, 'tree_to_ui'):
-                        self.tree_to_ui = {}
-                    self.tree_to_ui[tree_number] = descriptor_ui
-                    
-                    # Extract parent-child relationships
-                    self._extract_hierarchy_relations(tree_number, descriptor_name)
+        # Start from empty maps, so a fresh parse gives the same state as a cache hit
+        # and the cache entry never mixes in data from a previously parsed file
+        self.descriptor_details = {}  # Store complete MeSH information
+        self.descriptor_to_tree = defaultdict(list)
+        self.tree_to_descriptor = {}
+        self.ui_to_tree = defaultdict(list)
+        self.tree_to_ui = {}
+        
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(MeSHDescriptorHandler(self))
+        
+        # Open paths ourselves, xml.sax would otherwise treat a missing file name as a URL
+        if isinstance(xml_source, (str, os.PathLike)):
+            with open(xml_source, 'rb') as f:
+                parser.parse(f)
+        else:
+            parser.parse(xml_source)
+        
+        # Extract parent-child relationships once every tree number is known
+        self._extract_hierarchy_relations()
+        
+        if cache_key is not None:
+            self._save_cache(cache_key)
+    
+    def _cache_key(self, xml_path):
+        """
+        Hash the raw XML bytes (plus the cache format version) into a cache key
+        """
+        digest = hashlib.blake2b(CACHE_VERSION.encode(), digest_size=16)
+        with open(xml_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def _cache_path(self, cache_key):
+        return os.path.join(CACHE_DIR, f"{cache_key}.pkl")
+    
+    def _load_cache(self, cache_key):
+        """
+        Restore parsed state from the cache, returns False if there is no usable entry for this key
+        """
+        cache_path = self._cache_path(cache_key)
+        if not os.path.exists(cache_path):
+            return False
+        
+        try:
+            with open(cache_path, 'rb') as f:
+                state = pickle.load(f)
+        except (EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            # Truncated or unreadable entry, drop it so the next save replaces it
+            print(f"Ignoring unreadable MeSH cache entry {cache_path}: {e}")
+            os.remove(cache_path)
+            return False
+        
+        self.__dict__.update(state)
+        return True
+    
+    def _save_cache(self, cache_key):
+        """
+        Pickle everything parse_mesh_xml produces under the given key
+        """
+        state = {name: getattr(self, name) for name in CACHED_ATTRIBUTES}
+        
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        
+        # Write to a temp file first, an interrupted save must never leave a truncated entry behind
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._cache_path(cache_key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    
+    def _record_tree(self, descriptor_ui, descriptor_name, tree_number):
+        """
+        Store the mappings for one tree number of a descriptor
+        """
+        # Store mappings (keeping original functionality)
+        self.descriptor_to_tree[descriptor_name].append(tree_number)
+        self.tree_to_descriptor[tree_number] = descriptor_name
+        
+        # Store UI to tree mapping
+        self.ui_to_tree[descriptor_ui].append(tree_number)
+        
+        # Store tree to UI mapping
+        self.tree_to_ui[tree_number] = descriptor_ui
     
-    def _extract_hierarchy_relations(self, tree_number, descriptor_name):
+    def _record_descriptor(self, descriptor_ui, descriptor_name, definition, tree_numbers):
+        """
+        Store complete descriptor details once its record has been fully read
+        """
+        self.descriptor_details[descriptor_ui] = {
+            'mesh_id': descriptor_ui,
+            'name': descriptor_name,
+            'definition': definition,
+            'tree_numbers': tree_numbers
+        }
+    
+    def _build_tree_table(self):
+        """
+        Build a columnar table with one row per (term name, tree number),
+        plus the parent tree number (NaN for top-level trees like C01)
+        """
+        tree_to_descriptor = self.tree_to_descriptor
+        tree_numbers = list(tree_to_descriptor)
+        trees = pd.Series(tree_numbers, dtype=str)
+        return pd.DataFrame({
+            'name': pd.Categorical([tree_to_descriptor[t] for t in tree_numbers]),
+            'tree': trees,
+            'parent_tree': trees.str.extract(r'^(.*)\.[^.]*$', expand=False)
+        })
+    
+    def _extract_hierarchy_relations(self):
         """
         Extract parent-child relationships from tree numbers
-        Tree numbers like C01.123.456 indicate hierarchy levels
+        Tree numbers like C01.123.456 indicate hierarchy levels, the parent being C01.123
         """
-        parts = tree_number.split('.')
+        self.tree_table = self._build_tree_table()
+        self.parent_child_relations = defaultdict(list)
         
-        # Build parent tree numbers
-        for i in range(1, len(parts)):
-            parent_tree = '.'.join(parts[:i])
-            child_tree = '.'.join(parts[:i+1])
-            
-            if parent_tree in self.tree_to_descriptor and child_tree in self.tree_to_descriptor:
-                parent_name = self.tree_to_descriptor[parent_tree]
-                child_name = self.tree_to_descriptor[child_tree]
-                self.parent_child_relations[parent_name].add(child_name)
+        # Join every tree number to its parent tree number in one pass
+        parents = self.tree_table[['tree', 'name']].rename(columns={'tree': 'parent_tree', 'name': 'parent_name'})
+        edges = self.tree_table.merge(parents, on='parent_tree')[['parent_name', 'name']]
+        
+        # A descriptor can sit under the same parent via several tree numbers, keep each edge once
+        self.hierarchy_edges = edges.drop_duplicates(ignore_index=True)
+        
+        parent_child_relations = self.parent_child_relations
+        for parent_name, child_name in zip(self.hierarchy_edges['parent_name'], self.hierarchy_edges['name']):
+            parent_child_relations[parent_name].append(child_name)
     
     def get_label_hierarchy_for_micol(self):
         """
         Generate label-label similarity pairs for MICoL enhancement
         Returns pairs of (label1, label2) that are hierarchically related
         """
-        similar_pairs = []
-        
-        # Parent-child relationships (strong similarity)
-        for parent, children in self.parent_child_relations.items():
-            for child in children:
-                similar_pairs.append((parent, child, "parent_child"))
+        return self.similar_pairs
+    
+    @cached_property
+    def similar_pairs(self):
+        """
+        All (label1, label2, relation) pairs as a list, built once from the same table
+        save_hierarchy_data writes, so the list and the saved file always agree
+        """
+        return list(self._similar_pairs_table.itertuples(index=False, name=None))
+    
+    def _build_sibling_pairs(self):
+        """
+        Sibling pairs from a self-join of hierarchy_edges on the parent,
+        keeping each unordered pair once per shared parent
+        """
+        edges = self.hierarchy_edges
+        siblings = edges.merge(edges, on='parent_name', suffixes=('_a', '_b'))
         
-        # Sibling relationships (medium similarity)
-        for parent, children in self.parent_child_relations.items():
-            children_list = list(children)
-            for i, child1 in enumerate(children_list):
-                for child2 in children_list[i+1:]:
-                    similar_pairs.append((child1, child2, "siblings"))
+        # Both name columns share one set of categories, so comparing codes orders the names
+        siblings = siblings[siblings['name_a'].cat.codes < siblings['name_b'].cat.codes]
+        return siblings[['name_a', 'name_b']]
+    
+    @cached_property
+    def _similar_pairs_table(self):
+        """
+        All similar pairs as one table with label1, label2 and relation columns:
+        parent-child edges first, then sibling pairs with the names ordered by category code
+        Built once per parse, so the sibling self-join runs a single time
+        """
+        parent_child = self.hierarchy_edges.rename(columns={'parent_name': 'label1', 'name': 'label2'})
+        siblings = self._build_sibling_pairs().rename(columns={'name_a': 'label1', 'name_b': 'label2'})
         
+        similar_pairs = pd.concat([
+            parent_child.assign(relation="parent_child"),
+            siblings.assign(relation="siblings")
+        ], ignore_index=True)
+        return similar_pairs.astype({'relation': 'category'})
+    
+    def _save_similar_pairs(self, pairs_file):
+        """
+        Write similar pairs as a zstd-compressed Parquet table with label1, label2 and relation columns
+        """
+        similar_pairs = self._similar_pairs_table
+        similar_pairs.to_parquet(pairs_file, compression='zstd', index=False)
+        return len(similar_pairs)
+    
     def get_mesh_by_id(self, mesh_id):
         """
         Get complete MeSH information by Unique ID (like D016667)
@@ -159,10 +356,19 @@ class MeSHHierarchyExtractor:
         """
         Find MeSH ID by term name (like "Bacterial Capsules")
         """
+        mesh_id = self._name_lower_to_ui.get(term_name.lower())
+        return self.get_mesh_by_id(mesh_id) if mesh_id else None
+    
+    @cached_property
+    def _name_lower_to_ui(self):
+        """
+        Lowercase term name -> MeSH ID index for search_mesh_by_name, built on first search
+        """
+        name_lower_to_ui = {}
         for mesh_id, details in self.descriptor_details.items():
-            if details['name'].lower() == term_name.lower():
-                return self.get_mesh_by_id(mesh_id)
-        return None
+            # Keep the first descriptor for a name, as the old linear scan did
+            name_lower_to_ui.setdefault(details['name'].lower(), mesh_id)
+        return name_lower_to_ui
     
     def get_hierarchy_relations_by_id(self, mesh_id):
         """
@@ -179,13 +385,11 @@ class MeSHHierarchyExtractor:
         
         # Find parents by looking at shorter tree numbers
         for tree_num in tree_numbers:
-            parts = tree_num.split('.')
-            if len(parts) > 1:
-                parent_tree = '.'.join(parts[:-1])
-                if parent_tree in self.tree_to_ui:
-                    parent_id = self.tree_to_ui[parent_tree]
-                    parent_name = self.descriptor_details[parent_id]['name']
-                    parents.append({'id': parent_id, 'name': parent_name})
+            parent_tree, separator, _ = tree_num.rpartition('.')
+            if separator and parent_tree in self.tree_to_ui:
+                parent_id = self.tree_to_ui[parent_tree]
+                parent_name = self.descriptor_details[parent_id]['name']
+                parents.append({'id': parent_id, 'name': parent_name})
         
         return {
             'mesh_id': mesh_id,
@@ -195,7 +399,7 @@ class MeSHHierarchyExtractor:
             'tree_numbers': tree_numbers
         }
     
-    def save_hierarchy_data(self, output_file="mesh_hierarchy_v2.json"):
+    def save_hierarchy_data(self, output_file="mesh_hierarchy_v2.json", pairs_file="mesh_similar_pairs_v2.parquet"):
         """
         Save extracted hierarchy data to JSON file with complete MeSH information
         """
@@ -205,14 +409,19 @@ class MeSHHierarchyExtractor:
             "tree_to_descriptor": self.tree_to_descriptor,
             "ui_to_tree": dict(self.ui_to_tree),  # MeSH ID to tree mapping
             "tree_to_ui": self.tree_to_ui,  # Tree to MeSH ID mapping
-            "parent_child_relations": {k: list(v) for k, v in self.parent_child_relations.items()},
-            "similar_pairs": self.get_label_hierarchy_for_micol()
+            "parent_child_relations": dict(self.parent_child_relations)  # Children are already deduplicated lists
         }
         
-        with open(output_file, 'w') as f:
-            json.dump(hierarchy_data, f, indent=2)
+        # Similar pairs can run into the millions, so they are streamed to their own file
+        hierarchy_data["similar_pairs_file"] = pairs_file
+        hierarchy_data["similar_pairs_count"] = self._save_similar_pairs(pairs_file)
+        
+        # orjson serialises (and indents) in C, so the file stays readable at a fraction of the cost
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(hierarchy_data, option=orjson.OPT_INDENT_2))
         
         print(f"Hierarchy data saved to {output_file}")
+        print(f"Similar pairs saved to {pairs_file}")
         print(f"Sample MeSH entries with IDs:")
         
         # Show sample entries with the key fields you highlighted
@@ -233,11 +442,8 @@ def main():
     extractor = MeSHHierarchyExtractor()
     
     try:
-        with open('desc2025.xml', 'r', encoding='utf-8') as f:
-            xml_content = f.read()
-        
         print("Parsing MeSH XML...")
-        extractor.parse_mesh_xml(xml_content)
+        extractor.parse_mesh_xml('desc2025.xml')
         
         print("Extracting hierarchy relationships...")
         hierarchy_data = extractor.save_hierarchy_data()
@@ -246,12 +452,12 @@ def main():
         print(f"\nStatistics:")
         print(f"Total descriptors: {len(extractor.tree_to_descriptor)}")
         print(f"Total parent-child relations: {sum(len(children) for children in extractor.parent_child_relations.values())}")
-        # ßprint(f"Total similar pairs for training: {len(hierarchy_data['similar_pairs'])}")
+        print(f"Total similar pairs for training: {hierarchy_data['similar_pairs_count']}")
         
         # Show example relationships
         print(f"\nExample parent-child relationships:")
         for parent, children in list(extractor.parent_child_relations.items())[:5]:
-            print(f"  {parent} -> {list(children)[:3]}...")
+            print(f"  {parent} -> {children[:3]}...")
             
     except FileNotFoundError:
         print("Please download desc2020.xml from https://nlmpubs.nlm.nih.gov/projects/mesh/")
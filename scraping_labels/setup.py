@@ -0,0 +1,16 @@
+"""
+Optional: compile the MeSH scrapers with Cython for a faster parse
+
+    pip install cython
+    python setup.py build_ext --inplace
+
+The compiled modules shadow scraper.py / scraper_v2.py on import, delete the
+generated .so/.c files to go back to the pure Python versions
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="mesh-scraper",
+    ext_modules=cythonize(["scraper.py", "scraper_v2.py"], language_level=3),
+)